@@ -43,7 +43,21 @@ from typing import List, Tuple, Dict
 import numpy as np
 import h5py
 
-__all__ = ["get_new_obsname", "write_hdf5", "merge_hdf5", "get_obsnums"]
+__all__ = ["get_new_obsname", "write_hdf5", "merge_hdf5", "get_obsnums", "read_dataset"]
+
+
+def _create_frame_dataset(group: h5py.Group, name: str, data: np.ndarray) -> h5py.Dataset:
+    """
+    Create a compressed dataset stored as a single chunk
+
+    A movie reads one whole image (or matrix) per observation, so the chunk
+    covers the full array and each frame is read with one chunk lookup. The
+    shuffle filter groups the bytes of the floats before compression. gzip is
+    a standard HDF5 filter, so every HDF5 reader can open the files; level 1
+    is faster than the default level 4 and compresses nearly as well.
+    """
+    return group.create_dataset(name, data=data, chunks=data.shape or None,
+                                shuffle=True, compression="gzip", compression_opts=1)
 
 
 def get_new_obsname(h5file: h5py.File):
@@ -124,21 +138,53 @@ def write_hdf5(filename: str, xst_data: np.ndarray, visibilities: np.ndarray, sk
         obs_group.attrs["source_elevations"] = np.array([data['elevation'] for data in bodies_lmn.values()])
         obs_group.attrs["source_azimuths"] = np.array([data['azimuth'] for data in bodies_lmn.values()])
 
-        obs_group.create_dataset("xst_data", data=xst_data, compression="gzip")
-        obs_group.create_dataset("calibrated_data", data=visibilities, compression="gzip")
+        _create_frame_dataset(obs_group, "xst_data", xst_data)
+        # Calibrated data is single precision already (see apply_calibration)
+        _create_frame_dataset(obs_group, "calibrated_data", np.asarray(visibilities, dtype=np.complex64))
         for key, value in calibration_info.items():
             obs_group["calibrated_data"].attrs[key] = value
-        dataset_sky_img = obs_group.create_dataset("sky_img", data=sky_img, compression="gzip")
+        dataset_sky_img = _create_frame_dataset(obs_group, "sky_img", sky_img)
         dataset_sky_img.attrs["subtracted"] = subtracted
 
         ground_img_group = obs_group.create_group("ground_images")
-        dataset_ground_img = ground_img_group.create_dataset("ground_img000", data=ground_img, compression="gzip")
+        dataset_ground_img = _create_frame_dataset(ground_img_group, "ground_img000", ground_img)
         dataset_ground_img.attrs["extent"] = extent
         dataset_ground_img.attrs["extent_lonlat"] = extent_lonlat
         dataset_ground_img.attrs["height"] = height
         dataset_ground_img.attrs["subtracted"] = str(subtracted)
 
 
+def read_dataset(dataset: h5py.Dataset) -> np.ndarray:
+    """
+    Read a full dataset into memory
+
+    The data is read straight into a preallocated array with read_direct,
+    one chunk at a time for chunked datasets, which avoids the intermediate
+    copies made by np.array(dataset) or dataset[:].
+
+    Args:
+        dataset: HDF5 dataset to read
+
+    Returns:
+        np.ndarray: Array with the contents of the dataset
+
+    Example:
+        >>> with h5py.File("test/test.h5", 'r') as h5file:
+        ...     read_dataset(h5file["obs000002"]["sky_img"]).shape
+        (131, 131)
+    """
+    data = np.empty(dataset.shape, dtype=dataset.dtype)
+    if data.size == 0:
+        return data
+
+    if dataset.chunks is None:
+        dataset.read_direct(data)
+    else:
+        for chunk_slice in dataset.iter_chunks():
+            dataset.read_direct(data, source_sel=chunk_slice, dest_sel=chunk_slice)
+    return data
+
+
 def merge_hdf5(src_filename: str, dest_filename: str, obslist: List[str] = None):
     """
     Merge HDF5 files containing groups with observations called obs000001 etc.
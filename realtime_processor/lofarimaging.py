@@ -1,15 +1,21 @@
 """Functions for working with LOFAR single station data"""
 
+import functools
+import os
 from typing import Dict
 import numpy as np
 from numpy.linalg import norm, lstsq
 import numexpr as ne
 import numba
-from astropy.coordinates import SkyCoord, SkyOffsetFrame, CartesianRepresentation
+from astropy.coordinates import SkyCoord, SkyOffsetFrame, UnitSphericalRepresentation
 
+try:
+    from ducc0.wgridder.experimental import vis2dirty
+except ImportError:
+    vis2dirty = None
 
-__all__ = ["nearfield_imager", "sky_imager", "ground_imager", "skycoord_to_lmn", "calibrate", "simulate_sky_source",
-           "subtract_sources"]
+__all__ = ["nearfield_imager", "sky_imager", "fast_sky_imager", "ground_imager", "skycoord_to_lmn", "calibrate", "simulate_sky_source",
+           "subtract_sources", "stokes_i"]
 
 __version__ = "1.5.0"
 SPEED_OF_LIGHT = 299792458.0
@@ -27,19 +33,45 @@ def skycoord_to_lmn(pos: SkyCoord, phasecentre: SkyCoord):
 
     Note that this means that l increases east-wards
 
+    pos may be an array SkyCoord, in which case l, m and n are arrays
+    and all positions are converted in a single transformation.
+
     This function was taken from https://github.com/SKA-ScienceDataProcessor/algorithm-reference-library
     """
 
     # Determine relative sky position
     todc = pos.transform_to(SkyOffsetFrame(origin=phasecentre))
-    dc = todc.represent_as(CartesianRepresentation)
-    dc /= dc.norm()
+    # Direction only: the unit-sphere representation avoids normalising a Quantity vector
+    dc = todc.represent_as(UnitSphericalRepresentation).to_cartesian()
 
     # Do coordinate transformation - astropy's relative coordinates do
     # not quite follow imaging conventions
     return dc.y.value, dc.z.value, dc.x.value - 1
 
 
+@numba.jit(parallel=True, fastmath=True, nopython=True)
+def _stokes_i_kernel(visibilities, out):
+    for i in numba.prange(out.shape[0]):
+        for j in range(out.shape[1]):
+            out[i, j] = visibilities[2 * i, 2 * j] + visibilities[2 * i + 1, 2 * j + 1]
+    return out
+
+
+def stokes_i(visibilities):
+    """
+    Stokes I visibilities, the sum of the XX and YY polarisations
+
+    Args:
+        visibilities: Numpy array with visibilities, shape [num_rcus x num_rcus], ordered x, y, x, y, ...
+
+    Returns:
+        np.array(complex): Stokes I visibilities, shape [num_rcus // 2, num_rcus // 2]
+    """
+    num_antennas = visibilities.shape[0] // 2
+    out = np.empty((num_antennas, num_antennas), dtype=visibilities.dtype)
+    return _stokes_i_kernel(visibilities, out)
+
+
 @numba.jit(parallel=True, fastmath=True, nopython=True)
 def sky_imager(visibilities, baselines, freq, npix_l, npix_m):
     """
@@ -47,7 +79,9 @@ def sky_imager(visibilities, baselines, freq, npix_l, npix_m):
 
     Args:
         visibilities: Numpy array with visibilities, shape [num_antennas x num_antennas]
-        baselines: Numpy array with distances between antennas, shape [num_antennas, num_antennas, 3]
+        baselines: Numpy array with distances between antennas, shape [num_antennas, num_antennas, 3].
+                   Must be antisymmetric (baselines[j, i] == -baselines[i, j]), as when computed from
+                   antenna positions; only the upper triangle is used.
         freq: frequency
         npix_l: Number of pixels in l-direction
         npix_m: Number of pixels in m-direction
@@ -55,19 +89,101 @@ def sky_imager(visibilities, baselines, freq, npix_l, npix_m):
     Returns:
         np.array(float): Real valued array of shape [npix_l, npix_m]
     """
-    img = np.zeros((npix_m, npix_l), dtype=np.complex128)
-
-    for m_ix in range(npix_m):
+    img = np.empty((npix_m, npix_l), dtype=np.float64)
+    num_ant_1, num_ant_2 = visibilities.shape
+    phase_per_metre = -2 * np.pi * freq / SPEED_OF_LIGHT
+    # Phases and the sum over each antenna row are evaluated in single precision, which halves
+    # the cost of sin/cos; the rows are summed into the pixel in double precision
+    baselines_32 = baselines.astype(np.float32)
+
+    for m_ix in numba.prange(npix_m):
         m = -1 + m_ix * 2 / npix_m
         for l_ix in range(npix_l):
             l = 1 - l_ix * 2 / npix_l
+            if l * l + m * m > 1:
+                # Below the horizon
+                img[m_ix, l_ix] = np.nan
+                continue
             n = np.sqrt(1 - l * l - m * m) - 1
-            img[m_ix, l_ix] = np.mean(visibilities * np.exp(-2j * np.pi * freq *
-                                                            (baselines[:, :, 0] * l +
-                                                            baselines[:, :, 1] * m +
-                                                            baselines[:, :, 2] * n) /
-                                                            SPEED_OF_LIGHT))
-    return np.real(img)
+            phase_l = np.float32(phase_per_metre * l)
+            phase_m = np.float32(phase_per_metre * m)
+            phase_n = np.float32(phase_per_metre * n)
+            # Only the real part of the image is needed, so accumulate Re(vis * exp(j phase)) directly.
+            # Baseline (j, i) has the opposite phase of baseline (i, j), so both are summed as
+            # Re((vis[i, j] + conj(vis[j, i])) * exp(j phase)), evaluating each phase only once.
+            pixel = 0.
+            for i in range(num_ant_1):
+                pixel += visibilities[i, i].real
+                row = np.float32(0.)
+                for j in range(i + 1, num_ant_2):
+                    phase = (baselines_32[i, j, 0] * phase_l +
+                             baselines_32[i, j, 1] * phase_m +
+                             baselines_32[i, j, 2] * phase_n)
+                    vis_real = np.float32(visibilities[i, j].real + visibilities[j, i].real)
+                    vis_imag = np.float32(visibilities[i, j].imag - visibilities[j, i].imag)
+                    row += vis_real * np.cos(phase) - vis_imag * np.sin(phase)
+                pixel += row
+            img[m_ix, l_ix] = pixel / (num_ant_1 * num_ant_2)
+    return img
+
+
+def fast_sky_imager(visibilities, baselines, freq, npix_l, npix_m, epsilon=1e-5):
+    """
+    Sky imager using gridding and FFT instead of a direct Fourier transform per pixel
+
+    Computes the same image as sky_imager with the w-gridder of ducc0 (with w-correction),
+    to an accuracy of about epsilon relative to the image peak. Falls back to sky_imager
+    if ducc0 is not installed or the image is smaller than ducc0 supports (32 pixels).
+
+    Args:
+        visibilities: Numpy array with visibilities, shape [num_antennas x num_antennas]
+        baselines: Numpy array with distances between antennas, shape [num_antennas, num_antennas, 3].
+                   Must be antisymmetric, as for sky_imager.
+        freq: frequency
+        npix_l: Number of pixels in l-direction
+        npix_m: Number of pixels in m-direction
+        epsilon: Requested accuracy of the gridding (default 1e-5)
+
+    Returns:
+        np.array(float): Real valued array of shape [npix_l, npix_m]
+    """
+    if vis2dirty is None or min(npix_l, npix_m) < 32:
+        return sky_imager(visibilities, baselines, freq, npix_l, npix_m)
+
+    # ducc0 needs even image sizes; odd ones are computed one pixel larger and cropped.
+    # Its pixel coordinates are (-l, -m), so the centre is shifted to land on the
+    # sky_imager pixel grid (l from 1 downwards, m from -1 upwards).
+    npix_x, npix_y = npix_l + npix_l % 2, npix_m + npix_m % 2
+    crop_x, crop_y = npix_x - npix_l, npix_y - npix_m
+    pixsize_l, pixsize_m = 2 / npix_l, 2 / npix_m
+    # As in sky_imager, baseline (j, i) is the negation of (i, j), so each pair is gridded once as
+    # vis[i, j] + conj(vis[j, i]); the autocorrelations have zero phase and add a constant
+    rows, cols = _upper_triangle_indices(visibilities.shape[0])
+    pair_visibilities = visibilities[rows, cols] + np.conj(visibilities[cols, rows])
+    dirty = vis2dirty(uvw=np.ascontiguousarray(baselines[rows, cols], dtype=np.float64),
+                      freq=np.array([freq], dtype=np.float64),
+                      vis=pair_visibilities.astype(np.complex64).reshape(-1, 1),
+                      npix_x=npix_x, npix_y=npix_y, pixsize_x=pixsize_l, pixsize_y=pixsize_m,
+                      center_x=-crop_x / 2 * pixsize_l, center_y=(1 - crop_y / 2) * pixsize_m,
+                      epsilon=epsilon, do_wgridding=True, divide_by_n=False, nthreads=os.cpu_count() or 1)
+    img = dirty[crop_x:, crop_y:][:, ::-1].T.astype(np.float64)
+    img += np.sum(np.diagonal(visibilities).real)
+    img /= visibilities.size
+
+    # Below the horizon, with the same pixel coordinates as sky_imager
+    l = 1 - np.arange(npix_l) * 2 / npix_l
+    m = -1 + np.arange(npix_m) * 2 / npix_m
+    img[l[np.newaxis, :] * l[np.newaxis, :] + m[:, np.newaxis] * m[:, np.newaxis] > 1] = np.nan
+    return img
+
+
+@functools.lru_cache(maxsize=4)
+def _upper_triangle_indices(num_antennas):
+    """Row and column indices of the antenna pairs (i, j) with i < j, read-only"""
+    rows, cols = np.triu_indices(num_antennas, k=1)
+    rows.setflags(write=False)
+    cols.setflags(write=False)
+    return rows, cols
 
 
 def ground_imager(visibilities, freq, npix_p, npix_q, dims, station_pqr, height=1.5):
@@ -112,11 +228,13 @@ def nearfield_imager(visibilities, baseline_indices, freqs, npix_p, npix_q, exte
     posxyz = np.transpose(np.array([posx, posy, z * np.ones_like(posx)]), [1, 2, 0])
 
     diff_vectors = (station_pqr[:, None, None, :] - posxyz[None, :, :, :])
-    distances = np.linalg.norm(diff_vectors, axis=3)
+    # Single precision is ample for path lengths of at most a few km, and halves the
+    # memory traffic of the (memory bound) phase evaluation below
+    distances = np.linalg.norm(diff_vectors, axis=3).astype(np.float32)
 
-    vis_chunksize = max_memory_mb * 1024 * 1024 // (8 * npix_p * npix_q)
+    vis_chunksize = max_memory_mb * 1024 * 1024 // (distances.itemsize * npix_p * npix_q)
 
-    bl_diff = np.zeros((vis_chunksize, npix_q, npix_p), dtype=np.float64)
+    bl_diff = np.zeros((vis_chunksize, npix_q, npix_p), dtype=np.float32)
     img = np.zeros((npix_q, npix_p), dtype=np.complex128)
     for vis_chunkstart in range(0, len(baseline_indices), vis_chunksize):
         vis_chunkend = min(vis_chunkstart + vis_chunksize, baseline_indices.shape[0])
@@ -10,6 +10,8 @@ def main():
     parser = argparse.ArgumentParser(description="LOFAR Imaging Processor")
     parser.add_argument("data_path", help="Path to data directory")
     parser.add_argument("--realtime", action="store_true", help="Enable real-time observation mode")
+    parser.add_argument("--poll", action="store_true",
+                        help="Poll the data directory for changes (for NFS/CIFS mounts without change notifications)")
     args = parser.parse_args()
 
     input_dir = args.data_path
@@ -31,13 +33,12 @@ def main():
     print(f"Output directory: {output_dir}")
 
     app = QApplication(sys.argv) 
-    from threading import Event
     window = MainWindow(realtime_mode=args.realtime)
     window.show()
 
     # QThread setup
     thread = QThread()
-    worker = DataProcessorWorker(input_dir, output_dir, realtime_mode=args.realtime)
+    worker = DataProcessorWorker(input_dir, output_dir, realtime_mode=args.realtime, poll=args.poll)
     worker.moveToThread(thread)
     
     thread.started.connect(worker.run)
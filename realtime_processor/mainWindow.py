@@ -4,7 +4,7 @@ from PyQt6.QtWidgets import (
     QGroupBox, QVBoxLayout, QCheckBox
 )
 
-from PyQt6.QtCore import pyqtSignal, QCoreApplication
+from PyQt6.QtCore import pyqtSignal
 from realtime_processor.plot import Plot
 from datetime import datetime
 import configparser
@@ -81,7 +81,6 @@ class MainWindow(QMainWindow):
         """Update the plot with a new matrix."""
         self.plot_widget.plot_matrix(covariance_matrix, dat_path, subband, rcu_mode, obstime,
                                     sources_to_display=self.sources, vmin=None, vmax=None)
-        QCoreApplication.processEvents()
         ##Signal to indicate that the plot has been drawn
         self.plot_ready.emit() 
 
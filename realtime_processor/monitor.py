@@ -2,18 +2,42 @@ import os
 import time
 import numpy as np
 
+def find_files(input_dir, suffix):
+    """
+    Lists the regular files in a directory whose name ends with suffix.
+
+    Uses a single os.scandir pass; the returned os.DirEntry objects carry the name, path and cached file type.
+    """
+    with os.scandir(input_dir) as entries:
+        return [entry for entry in entries if entry.name.endswith(suffix) and entry.is_file()]
+
 def wait_for_dat_file(input_dir):
     """Waits until a .dat file appears in the input directory."""
     dat_file = None
     while not dat_file:
-        files = [f for f in os.listdir(input_dir) if f.endswith("_xst.dat")]
+        files = find_files(input_dir, "_xst.dat")
         if files:
-            dat_file = os.path.join(input_dir, files[0])
+            dat_file = files[0].path
         else:
             print("Waiting for .dat file")
             time.sleep(1)
     return dat_file
 
+def open_dat_file(dat_path, num_rcu=192, buffered_matrices=8):
+    """
+    Opens a .dat file for sequential reading of covariance matrices.
+
+    The read buffer holds several matrices, so consecutive reads are served from
+    one large sequential read instead of one system call per matrix. Where
+    supported, the kernel is told that the file is read sequentially, which
+    enlarges its read-ahead.
+    """
+    matrix_size_bytes = num_rcu * num_rcu * np.dtype(np.complex128).itemsize
+    f = open(dat_path, "rb", buffering=buffered_matrices * matrix_size_bytes)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
+
 def detect_new_data_from_stream(f, last_size, first_block_read=False, num_rcu=192, realtime_mode=False, last_time=None):
     """
     Reads new data from the .dat file in fixed-size chunks.
@@ -32,18 +56,16 @@ def detect_new_data_from_stream(f, last_size, first_block_read=False, num_rcu=19
         f.seek(0)
 
     chunk_bytes = f.read(matrix_size_bytes)
-    if not chunk_bytes or len(chunk_bytes) < matrix_size_bytes:
+    if len(chunk_bytes) < matrix_size_bytes:
+        # The matrix is not completely written yet: rewind, so that it is read whole next time
+        if chunk_bytes:
+            f.seek(-len(chunk_bytes), os.SEEK_CUR)
         return None, last_size, last_time
 
     chunk = np.frombuffer(chunk_bytes, dtype=np.complex128, count=num_rcu * num_rcu)
     chunk = chunk.reshape((num_rcu, num_rcu))
 
-    now = time.time()
-    speed = None
-    if last_time is not None:
-        speed = now - last_time
-        print(f"Time since last chunk: {speed:.3f} seconds")
-    last_time = now
+    last_time = time.time()
 
     # if realtime_mode and last_size > 0:
         # print(f"Current arrays read: {last_size / matrix_size_bytes}")
@@ -53,23 +75,36 @@ def detect_new_data_from_stream(f, last_size, first_block_read=False, num_rcu=19
     # print(chunk)
     return chunk, last_size, last_time
 
-def get_data_each_minute(f, inputSubband, min_subband, max_subband, num_rcu=192):
+def open_subband_memmap(dat_path, min_subband, max_subband, num_rcu=192):
+    """
+    Memory-maps a .dat file that holds one covariance matrix per subband.
+
+    Args:
+        dat_path (str or file object): The .dat file.
+        min_subband (int): Subband of the first matrix in the file.
+        max_subband (int): Subband of the last matrix in the file.
+        num_rcu (int): Number of RCUs (default: 192).
+
+    Returns:
+        np.memmap: Read-only array of shape [max_subband - min_subband + 1, num_rcu, num_rcu];
+        the matrix of a subband is paged in from disk only when it is accessed.
+    """
+    return np.memmap(dat_path, dtype=np.complex128, mode="r",
+                     shape=(max_subband - min_subband + 1, num_rcu, num_rcu))
+
+def get_data_each_minute(f, inputSubband, min_subband, max_subband, num_rcu=192, subband_memmap=None):
     """
     Reads the specific array covariance for this specific subband
 
     Args:
         f (file object): Open file object for the .dat file.
         subband (int): The subband to read data from.
+        subband_memmap (np.memmap): Map of the file from open_subband_memmap, to reuse when reading
+            many subbands. If None, the file is mapped for this call only.
 
     Returns:
         np.ndarray or None: The covariance matrix for the specified subband, or None if not found.
     """
-    matrix_size_bytes = num_rcu * num_rcu * np.dtype(np.complex128).itemsize
-    # Seek to the position of the subband
-    f.seek((inputSubband - min_subband) * matrix_size_bytes)
-    print(f"Reading subband {inputSubband - min_subband} at position {f.tell()}")
-    chunk_bytes = f.read(matrix_size_bytes)
-    chunk = np.frombuffer(chunk_bytes, dtype=np.complex128, count=num_rcu * num_rcu)
-    chunk = chunk.reshape((num_rcu, num_rcu))
-    
-    return chunk
+    if subband_memmap is None:
+        subband_memmap = open_subband_memmap(f, min_subband, max_subband, num_rcu)
+    return subband_memmap[inputSubband - min_subband]
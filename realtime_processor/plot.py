@@ -2,19 +2,25 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib import cm
 from matplotlib.patches import Circle
+from matplotlib.collections import LineCollection, PatchCollection
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import matplotlib.axes as maxes
 import numpy as np
 import os
+import io
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from PIL import Image
 
 import astropy.units as u
-from realtime_processor.lofarimaging import sky_imager, skycoord_to_lmn
-from realtime_processor.singlestationutil import apply_calibration, get_station_xyz, get_full_station_name, freq_from_sb
-from astropy.coordinates import SkyCoord, AltAz, EarthLocation, GCRS, get_sun, get_body
+from realtime_processor.lofarimaging import fast_sky_imager, skycoord_to_lmn, stokes_i
+from realtime_processor.singlestationutil import apply_calibration, get_full_station_name, freq_from_sb, \
+    get_station_baselines, get_station_earthlocation
+from astropy.coordinates import SkyCoord, AltAz, GCRS, get_sun, get_body
 from astropy.time import Time
-from lofarantpos.db import LofarAntennaDatabase
 import configparser
+import functools
+
 class Plot(FigureCanvas):
     def __init__(self, parent=None):
         self.fig = Figure(figsize=(8, 8))
@@ -22,7 +28,11 @@ class Plot(FigureCanvas):
         self.ax = self.fig.add_subplot(1, 1, 1)
         self.image = None 
         self.colorbar = None
-        self.marker_sources = []
+        self.source_labels = {}
+        # One thread, so PNGs are written in the order they were rendered
+        self._png_executor = ThreadPoolExecutor(max_workers=1)
+        # Output directories that exist already, so they are created once and not for every frame
+        self._created_dirs = set()
         self._setup_axes()
 
     def _setup_axes(self):
@@ -32,32 +42,33 @@ class Plot(FigureCanvas):
         self.ax.set_yticks([])
         self.ax.set_aspect('equal')
 
-        ## elevation rings
-        for el in [15, 30, 45, 60, 75]:
+        ## elevation rings, as one collection
+        elevations = [15, 30, 45, 60, 75]
+        rings = [Circle((0, 0), np.cos(np.deg2rad(el))) for el in elevations]
+        self.ax.add_collection(PatchCollection(rings, edgecolor='black', facecolor='none',
+                                               linestyle='-', alpha=0.7, zorder=1, linewidth=0.5))
+
+        ## labeling the rings
+        theta = np.deg2rad(337)
+        for el in elevations:
             radius = np.cos(np.deg2rad(el))
-            ring = Circle((0, 0), radius,   
-                          edgecolor='black', facecolor='none',
-                          linestyle='-', alpha=0.7, zorder=1, linewidth=0.5)
-            self.ax.add_patch(ring)
-        
-            ## labeling the rings
-            theta = np.deg2rad(337)
             x, y = np.sin(theta)*radius, np.cos(theta)*radius
             self.ax.text(x, y + 0.02, f"{el}°",
                          color='black', fontsize=6,
                          ha='left', va='bottom', zorder=2)
 
-        ## azimuth spokes every 45°
+        ## azimuth spokes every 45°, as one collection
+        azimuths = np.deg2rad(np.arange(0, 360, 45))
+        spoke_ends = np.stack([np.sin(azimuths), np.cos(azimuths)], axis=1)
+        spokes = np.stack([np.zeros_like(spoke_ends), spoke_ends], axis=1)
+        self.ax.add_collection(LineCollection(spokes, linestyle='-', color='black',
+                                              alpha=0.7, zorder=1, linewidth=0.5, capstyle='projecting'))
+
+        ## labeling spokes
         for az in range(0, 360, 45):
             theta = np.deg2rad(az)
             x = np.sin(theta)
             y = np.cos(theta)
-            ## spoke line
-            self.ax.plot([0, x], [0, y],
-                         linestyle='-', color='black',
-                         alpha=0.7, zorder=1, linewidth=0.5)
-            
-            ## labeling spokes
             self.ax.text(1.1*x, 1.1*y,
                          f"{az}°",
                          ha='center', va='center',
@@ -71,6 +82,15 @@ class Plot(FigureCanvas):
                          ha='center', va='center',
                          color='black', fontsize=14, zorder=2)
 
+        ## horizon, also used to clip the sky image
+        self.horizon = Circle((0, 0), 1.0, edgecolor='k', fill=False, facecolor='none', alpha=0.3)
+        self.ax.add_artist(self.horizon)
+
+        ## source markers and info texts, updated for every frame
+        self.source_markers, = self.ax.plot([], [], linestyle='none', marker='x', color='black', mew=0.5)
+        self.info_text = self.fig.text(0.5, 0.94, "", ha='center', va='top', fontsize=8, color='black')
+        self.info_text_not_visible = self.fig.text(0.5, 0.94, "", ha='center', va='top', fontsize=8, color='red')
+
         self.fig.tight_layout(rect=[0, 0, 1, 0.84])
 
     def plot_matrix(self,
@@ -87,64 +107,66 @@ class Plot(FigureCanvas):
     npix_l = 131,
     npix_m = 131,
     **kwargs):
-    
-        config = configparser.ConfigParser()
-        config.read(configSourcersFile)
-        
+
         assert xst_data.ndim == 2, "xst_data must be a 2D array"
 
         freq = freq_from_sb(subband, rcu_mode)
         visibilities, calibration_info = apply_calibration(xst_data, station_name, rcu_mode, subband,
                                                     caltable_dir=caltable_dir)
-        db = LofarAntennaDatabase()
-        # Split into the XX and YY polarisations (RCUs)
-        visibilities_xx = visibilities[0::2, 0::2]
-        visibilities_yy = visibilities[1::2, 1::2]
-        # Stokes I
-        visibilities_stokes_i = visibilities_xx + visibilities_yy
+        # Stokes I from the XX and YY polarisations (RCUs)
+        visibilities_stokes_i = stokes_i(visibilities)
         
-        station_xyz, pqr_to_xyz = get_station_xyz(station_name, rcu_mode, db)
+        baselines = get_station_baselines(station_name, rcu_mode)
 
         station_name = get_full_station_name(station_name, rcu_mode)
 
-        baselines = station_xyz[:, np.newaxis, :] - station_xyz[np.newaxis, :, :]
-
         # print(visibilities_stokes_i)
-        sky_img = sky_imager(visibilities_stokes_i, baselines, freq, npix_l, npix_m)
+        sky_img = fast_sky_imager(visibilities_stokes_i, baselines, freq, npix_l, npix_m)
 
         obstime_astropy = Time(obstime)
-        station_earthlocation = EarthLocation.from_geocentric(*(db.phase_centres[station_name] * u.m))
+        station_earthlocation = get_station_earthlocation(station_name)
         gcrs_instance = GCRS(obstime = obstime_astropy)
         zenith = AltAz(az=0 * u.deg, alt=90 * u.deg, obstime=obstime_astropy,
                     location=station_earthlocation).transform_to(gcrs_instance)
     
-        marked_bodies = self.load_marked_bodies(obstime_astropy, gcrs_instance, configSourcersFile)
+        altaz_frame = AltAz(location=station_earthlocation, obstime=obstime_astropy)
+
+        # The fixed sources are one cached array SkyCoord, masked down to the displayed ones
+        static_names, static_coords = _load_static_sources(configSourcersFile, _mtime(configSourcersFile))
+        is_displayed = np.isin(static_names, list(sources_to_display))
+        body_groups = [(static_names[is_displayed], static_coords[is_displayed])]
 
-        filtered_bodies = {}
-        for k, v in marked_bodies.items():
-            if k in sources_to_display:
-                filtered_bodies[k] = v
-        marked_bodies = filtered_bodies
+        # The Sun and Moon share a frame, so they are stacked into one SkyCoord as well
+        moving_bodies = {name: coord for name, coord in
+                         _load_moving_bodies(configSourcersFile, obstime_astropy, gcrs_instance).items()
+                         if name in sources_to_display}
+        if moving_bodies:
+            body_groups.append((np.array(list(moving_bodies), dtype=str), SkyCoord(list(moving_bodies.values()))))
+
+        marked_bodies = sorted(static_names[is_displayed].tolist() + list(moving_bodies))
 
         marked_bodies_lmn = {}
-        for body_name, body_coord in marked_bodies.items():
-            # print(body_name, body_coord.separation(zenith), body_coord.transform_to(AltAz(location=station_earthlocation, obstime=obstime_astropy)).alt)
-            altaz = body_coord.transform_to(AltAz(location=station_earthlocation, obstime=obstime_astropy))
-            if altaz.alt > 0:
+        for names, coords in body_groups:
+            if len(names) == 0:
+                continue
+            altaz = coords.transform_to(altaz_frame)
+            elevations, azimuths = altaz.alt.deg, altaz.az.deg
+            above_horizon = elevations > 0
+            if not above_horizon.any():
+                continue
+            l, m, n = skycoord_to_lmn(coords[above_horizon], zenith)
+            for body_name, lmn, elevation, azimuth in zip(names[above_horizon].tolist(), zip(l, m, n),
+                                                          elevations[above_horizon], azimuths[above_horizon]):
                 marked_bodies_lmn[body_name] = {
-                    'lmn' : skycoord_to_lmn(marked_bodies[body_name], zenith),
-                    'elevation': altaz.alt.deg,
-                    'azimuth': altaz.az.deg
+                    'lmn': lmn,
+                    'elevation': elevation,
+                    'azimuth': azimuth
                 }
-        
-        self.clear_plot()
-
-        circle1 = Circle((0, 0), 1.0, edgecolor='k', fill=False, facecolor='none', alpha=0.3)
-        self.ax.add_artist(circle1)
+        marked_bodies_lmn = dict(sorted(marked_bodies_lmn.items()))
 
         if self.image is None:
             self.image = self.ax.imshow(sky_img, origin='lower', cmap=cm.Spectral_r,
-                                        extent=(1, -1, -1, 1), clip_path=circle1, clip_on=True, **kwargs)
+                                        extent=(1, -1, -1, 1), clip_path=self.horizon, clip_on=True, **kwargs)
             divider = make_axes_locatable(self.ax)
             cax = divider.append_axes("right", size="5%", pad=1, axes_class=maxes.Axes)
             self.colorbar = self.fig.colorbar(self.image, cax=cax, orientation="vertical", format="%.2e")
@@ -170,37 +192,16 @@ class Plot(FigureCanvas):
         lines = subtitle_text.count('\n') + 1
         line_height = 0.018
 
-        self.info_text = self.fig.text(
-            0.5, 0.94, subtitle_text,
-            ha='center', va='top',
-            fontsize=8,
-            color='black'
-        )
-        
+        self.info_text.set_text(subtitle_text)
+
+        # Not visible sources in red below the main subtitle
         not_visible_bodies = self.get_marked_bodies_not_visible(marked_bodies_lmn, marked_bodies)
-        
-        if not_visible_bodies:
-            not_visible_text = ", ".join(not_visible_bodies)
-            # Add the text in red below the main subtitle
-            y_pos = self.info_text.get_position()[1] - lines * line_height
-
-            self.info_text_not_visible = self.fig.text(
-                0.5, y_pos,
-                not_visible_text,
-                ha='center', va='top',
-                fontsize=8,
-                color='red'
-            )
-
-        if marked_bodies_lmn:
-            for body_name, data in marked_bodies_lmn.items():
-                lmn = data['lmn']
-                marker, = self.ax.plot([lmn[0]], [lmn[1]], marker='x', color='black', mew=0.5)
-                label = self.ax.text(lmn[0], lmn[1], body_name, color='black',
-                            fontsize=9, ha='left', va='bottom', zorder=2)
-                
-                self.marker_sources.extend([marker, label])
-        
+        self.info_text_not_visible.set_text(", ".join(not_visible_bodies))
+        self.info_text_not_visible.set_y(self.info_text.get_position()[1] - lines * line_height)
+        self.info_text_not_visible.set_visible(bool(not_visible_bodies))
+
+        self.update_source_markers(marked_bodies_lmn)
+
         self.draw()
 
 
@@ -208,7 +209,27 @@ class Plot(FigureCanvas):
         today_date = datetime.today().strftime('%Y-%m-%d')
         output_dir = os.path.join(os.path.dirname(dat_path), f"{today_date}_realtime_observation")
         print(output_dir)
-        self.fig.savefig(os.path.join(output_dir, f'{fname}_sky_calibrated_{freq / 1e6:.1f}MHz.png'), bbox_inches='tight', dpi=200)
+        self.save_png(os.path.join(output_dir, f'{fname}_sky_calibrated_{freq / 1e6:.1f}MHz.png'), dpi=200)
+
+    def save_png(self, path, dpi=200):
+        '''
+        Save the figure as a PNG.
+        The figure is rendered here; the PNG compression runs in a background thread,
+        so the next frame can be processed in the meantime.
+        The layout is fixed in _setup_axes, so the full figure is saved instead of
+        recomputing a tight bounding box over all artists for every frame.
+        Errors while writing are reported when the background write finishes.
+        '''
+        # The output directory is named after the date, so a run past midnight needs a new one
+        directory = os.path.dirname(path) or '.'
+        if directory not in self._created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._created_dirs.add(directory)
+        buffer = io.BytesIO()
+        self.fig.savefig(buffer, format='rgba', dpi=dpi)
+        width, height = self.fig.get_size_inches() * dpi
+        future = self._png_executor.submit(_write_png, buffer.getvalue(), (int(width), int(height)), path)
+        future.add_done_callback(functools.partial(_report_png_error, path))
 
     def get_marked_bodies_not_visible(self, marked_bodies_lmn, marked_bodies):
         '''
@@ -220,43 +241,122 @@ class Plot(FigureCanvas):
                 not_visible_bodies.append(name)
         return not_visible_bodies
     
+    def update_source_markers(self, marked_bodies_lmn):
+        '''
+        Move the source markers and labels to the given lmn positions and hide the labels of other sources.
+        The artists are created once and reused for every frame.
+        '''
+        self.source_markers.set_data([data['lmn'][0] for data in marked_bodies_lmn.values()],
+                                     [data['lmn'][1] for data in marked_bodies_lmn.values()])
+        for body_name, label in self.source_labels.items():
+            label.set_visible(body_name in marked_bodies_lmn)
+        for body_name, data in marked_bodies_lmn.items():
+            lmn = data['lmn']
+            if body_name in self.source_labels:
+                self.source_labels[body_name].set_position((lmn[0], lmn[1]))
+            else:
+                self.source_labels[body_name] = self.ax.text(lmn[0], lmn[1], body_name, color='black',
+                                                             fontsize=9, ha='left', va='bottom', zorder=2)
+
     def clear_plot(self):
         '''
-        Clear the plot by removing all artists and resetting the axes.
+        Clear the source markers, labels and info texts. The artists themselves are kept for the next frame.
         '''
-        for artist in getattr(self, "marker_sources", []):
-            artist.remove()
-        self.marker_sources = []
-        
-        # Remove previous info text if it exists
-        if hasattr(self, "info_text") and self.info_text is not None:
-            self.info_text.remove()
+        self.update_source_markers({})
+        self.info_text.set_text("")
+        self.info_text_not_visible.set_visible(False)
 
-        if hasattr(self, "info_text_not_visible") and self.info_text_not_visible is not None:
-            self.info_text_not_visible.remove()
-    
     def load_marked_bodies(self, obstime_astropy, gcrs_instance, sources_ini_path):
         '''
         Load marked bodies from the sources.ini file.
         '''
-        config = configparser.ConfigParser()
-        config.read(sources_ini_path)
-        marked_bodies = {}
-
-        for section in config.sections():
-            if section == "Moon":
-                marked_bodies["Moon"] = get_body('moon', time=obstime_astropy)
-            elif section == "Sun":
-                sun = get_sun(time=obstime_astropy)
-                if gcrs_instance is not None:
-                    sun = sun.transform_to(gcrs_instance)
-                marked_bodies["Sun"] = sun
-            elif "RA" in config[section] and "DEC" in config[section]:
-                ra = float(config[section]["RA"])
-                dec = float(config[section]["DEC"])
-                marked_bodies[section] = SkyCoord(ra=ra * u.deg, dec=dec * u.deg)
-            elif "ICRS_coord" in config[section]:
-                icrs = config[section]["ICRS_coord"]
-                marked_bodies[section] = SkyCoord(icrs, unit=(u.hourangle, u.deg))
+        static_names, static_coords = _load_static_sources(sources_ini_path, _mtime(sources_ini_path))
+        marked_bodies = dict(zip(static_names.tolist(), static_coords))
+        marked_bodies.update(_load_moving_bodies(sources_ini_path, obstime_astropy, gcrs_instance))
         marked_bodies = dict(sorted(marked_bodies.items()))
-        return marked_bodies
\ No newline at end of file
+        return marked_bodies
+
+
+def _report_png_error(path, future):
+    '''
+    Report an exception raised while writing a PNG in the background thread.
+    '''
+    exception = future.exception()
+    if exception is not None:
+        print(f"Error writing {path}: {exception!r}")
+
+
+def _write_png(rgba, size, path):
+    '''
+    Compress a raw RGBA buffer to a PNG file.
+    '''
+    Image.frombuffer('RGBA', size, rgba, 'raw', 'RGBA', 0, 1).save(path, compress_level=1)
+
+
+def _load_moving_bodies(sources_ini_path, obstime_astropy, gcrs_instance):
+    '''
+    Compute the positions of the Sun and the Moon, if they are listed in the sources.ini file.
+    '''
+    config = _read_sources_config(sources_ini_path, _mtime(sources_ini_path))
+    moving_bodies = {}
+    if config.has_section("Moon"):
+        moving_bodies["Moon"] = get_body('moon', time=obstime_astropy)
+    if config.has_section("Sun"):
+        sun = get_sun(time=obstime_astropy)
+        if gcrs_instance is not None:
+            sun = sun.transform_to(gcrs_instance)
+        moving_bodies["Sun"] = sun
+    return moving_bodies
+
+
+def _mtime(path):
+    '''
+    Modification time of a file, or None if it does not exist. Used to key the sources.ini caches,
+    so that an edited file is parsed again.
+    '''
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=4)
+def _read_sources_config(sources_ini_path, mtime):
+    '''
+    Parse a sources.ini file once per path and modification time.
+    '''
+    config = configparser.ConfigParser()
+    config.read(sources_ini_path)
+    return config
+
+
+@functools.lru_cache(maxsize=4)
+def _load_static_sources(sources_ini_path, mtime):
+    '''
+    Build one array SkyCoord of the fixed sources (everything except Sun and Moon) in a sources.ini file.
+
+    Returns the source names as an array and the matching SkyCoord: first the sources given by RA and DEC,
+    then the ones given by ICRS_coord, each in the order of the file.
+    '''
+    config = _read_sources_config(sources_ini_path, mtime)
+    names, ras, decs = [], [], []
+    icrs_names, icrs_coords = [], []
+
+    for section in config.sections():
+        if "RA" in config[section] and "DEC" in config[section]:
+            names.append(section)
+            ras.append(float(config[section]["RA"]))
+            decs.append(float(config[section]["DEC"]))
+        elif "ICRS_coord" in config[section]:
+            icrs_names.append(section)
+            icrs_coords.append(config[section]["ICRS_coord"])
+
+    # Parse the sexagesimal entries in one go and append them to the RA/DEC ones
+    if icrs_names:
+        parsed = SkyCoord(icrs_coords, unit=(u.hourangle, u.deg))
+        names.extend(icrs_names)
+        ras.extend(parsed.ra.deg)
+        decs.extend(parsed.dec.deg)
+
+    static_coords = SkyCoord(ra=np.array(ras, dtype=float) * u.deg, dec=np.array(decs, dtype=float) * u.deg)
+    return np.array(names, dtype=str), static_coords
@@ -1,10 +1,23 @@
+import functools
+import os
 import re
 
+_RE_HEADER_XCSUBBAND = re.compile(r'--xcsubband=(\d+)')
+_RE_XCSUBBAND = re.compile(r"--xcsubband\s*=\s*(\d+)")
+_RE_SUBBAND_RANGE = re.compile(r"subbands=['\"]?(\d+):(\d+)['\"]?")
+_RE_RCUMODE = re.compile(r"rcumode=(\d)")
+
 def get_subband(file_path):
+    return _get_subband_cached(file_path, os.path.getmtime(file_path))
+
+# The parsers below are called for every new .dat file; they are cached on (path, mtime),
+# so an edited file is parsed again
+@functools.lru_cache(maxsize=256)
+def _get_subband_cached(file_path, mtime):
     with open(file_path, 'r') as file:
         content = file.read()
 
-    match = re.search(r'--xcsubband=(\d+)', content)
+    match = _RE_HEADER_XCSUBBAND.search(content)
     if match:
         subband = int(match.group(1))
     else:
@@ -14,6 +27,10 @@ def get_subband(file_path):
 
 def get_subband_from_shell(shell_script):
     """Extract subband from a shell script (.sh)."""
+    return _get_subband_from_shell_cached(shell_script, os.path.getmtime(shell_script))
+
+@functools.lru_cache(maxsize=256)
+def _get_subband_from_shell_cached(shell_script, mtime):
     xcsubband = None
 
     with open(shell_script, "r") as file:
@@ -23,14 +40,14 @@ def get_subband_from_shell(shell_script):
     for line in lines:
         # Ignore lines that start with '#' (commented out)
         if not line.strip().startswith("#"):
-            match_a = re.search(r"--xcsubband\s*=\s*(\d+)", line)
+            match_a = _RE_XCSUBBAND.search(line)
             if match_a:
                 # print(f"Subband: {match_a.group(1)}")
                 return int(match_a.group(1)), int(match_a.group(1))
 
     # If not found, look for subbands=['150:271'] (even in commented lines)
     for line in lines:
-        match_b = re.search(r"subbands=['\"]?(\d+):(\d+)['\"]?", line)
+        match_b = _RE_SUBBAND_RANGE.search(line)
         if match_b:
             first_number = int(match_b.group(1))
             second_number = int(match_b.group(2))
@@ -43,10 +60,18 @@ def get_subband_from_shell(shell_script):
 
 def get_rcu_mode(shell_script):
     """Extract RCU mode from a shell script (.sh)."""
+    try:
+        mtime = os.path.getmtime(shell_script)
+    except OSError:
+        mtime = None
+    return _get_rcu_mode_cached(shell_script, mtime)
+
+@functools.lru_cache(maxsize=256)
+def _get_rcu_mode_cached(shell_script, mtime):
     try:
         with open(shell_script, "r") as file:
             for line in file:
-                match = re.search(r"rcumode=(\d)", line)
+                match = _RE_RCUMODE.search(line)
                 if match:
                     return match.group(1)
     except Exception as e:
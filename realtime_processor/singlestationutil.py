@@ -8,11 +8,15 @@
 
 import os
 import datetime
+import functools
+import pathlib
+import re
+from enum import IntEnum
 import configparser
 from typing import List, Dict, Tuple, Union
 
 import numpy as np
-from packaging import version
+import numba
 import tqdm
 import h5py
 
@@ -33,28 +37,112 @@ from astropy.time import Time
 from lofarantpos.db import LofarAntennaDatabase
 import lofarantpos
 
-from .lofarimaging import sky_imager, skycoord_to_lmn, subtract_sources
-from .hdf5util import write_hdf5
+from .lofarimaging import fast_sky_imager, skycoord_to_lmn, subtract_sources, stokes_i
+from .hdf5util import write_hdf5, read_dataset
 
 
-__all__ = ["sb_from_freq", "freq_from_sb", "find_caltable", "read_caltable",
+__all__ = ["RCUMode", "sb_from_freq", "freq_from_sb", "find_caltable", "read_caltable", "read_acm_cube",
            "rcus_in_station", "get_station_pqr", "get_station_xyz", "get_station_type",
-            "apply_calibration", "get_full_station_name", "make_sky_movie", "reimage_sky"]
+           "apply_calibration", "get_full_station_name", "get_station_baselines", "get_station_earthlocation",
+           "make_sky_movie", "reimage_sky"]
 
 __version__ = "1.5.0"
 
 # Configurations for HBA observations with a single dipole activated per tile.
-GENERIC_INT_201512 = [0, 5, 3, 1, 8, 3, 12, 15, 10, 13, 11, 5, 12, 12, 5, 2, 10, 8, 0, 3, 5, 1, 4, 0, 11, 6, 2, 4, 9,
-                      14, 15, 3, 7, 5, 13, 15, 5, 6, 5, 12, 15, 7, 1, 1, 14, 9, 4, 9, 3, 9, 3, 13, 7, 14, 7, 14, 2, 8,
-                      8, 0, 1, 4, 2, 2, 12, 15, 5, 7, 6, 10, 12, 3, 3, 12, 7, 4, 6, 0, 5, 9, 1, 10, 10, 11, 5, 11, 7, 9,
-                      7, 6, 4, 4, 15, 4, 1, 15]
-GENERIC_CORE_201512 = [0, 10, 4, 3, 14, 0, 5, 5, 3, 13, 10, 3, 12, 2, 7, 15, 6, 14, 7, 5, 7, 9, 0, 15, 0, 10, 4, 3, 14,
-                       0, 5, 5, 3, 13, 10, 3, 12, 2, 7, 15, 6, 14, 7, 5, 7, 9, 0, 15]
-GENERIC_REMOTE_201512 = [0, 13, 12, 4, 11, 11, 7, 8, 2, 7, 11, 2, 10, 2, 6, 3, 8, 3, 1, 7, 1, 15, 13, 1, 11, 1, 12, 7,
-                         10, 15, 8, 2, 12, 13, 9, 13, 4, 5, 5, 12, 5, 5, 9, 11, 15, 12, 2, 15]
+GENERIC_INT_201512 = np.array([0, 5, 3, 1, 8, 3, 12, 15, 10, 13, 11, 5, 12, 12, 5, 2, 10, 8, 0, 3, 5, 1, 4, 0, 11, 6,
+                               2, 4, 9, 14, 15, 3, 7, 5, 13, 15, 5, 6, 5, 12, 15, 7, 1, 1, 14, 9, 4, 9, 3, 9, 3, 13,
+                               7, 14, 7, 14, 2, 8, 8, 0, 1, 4, 2, 2, 12, 15, 5, 7, 6, 10, 12, 3, 3, 12, 7, 4, 6, 0, 5,
+                               9, 1, 10, 10, 11, 5, 11, 7, 9, 7, 6, 4, 4, 15, 4, 1, 15], dtype=np.int8)
+GENERIC_CORE_201512 = np.array([0, 10, 4, 3, 14, 0, 5, 5, 3, 13, 10, 3, 12, 2, 7, 15, 6, 14, 7, 5, 7, 9, 0, 15, 0, 10,
+                                4, 3, 14, 0, 5, 5, 3, 13, 10, 3, 12, 2, 7, 15, 6, 14, 7, 5, 7, 9, 0, 15],
+                                dtype=np.int8)
+GENERIC_REMOTE_201512 = np.array([0, 13, 12, 4, 11, 11, 7, 8, 2, 7, 11, 2, 10, 2, 6, 3, 8, 3, 1, 7, 1, 15, 13, 1, 11,
+                                  1, 12, 7, 10, 15, 8, 2, 12, 13, 9, 13, 4, 5, 5, 12, 5, 5, 9, 11, 15, 12, 2, 15],
+                                  dtype=np.int8)
+
+assert tuple(map(int, re.match(r"(\d+)\.(\d+)", lofarantpos.__version__).groups())) >= (0, 4), \
+    "lofarantpos>=0.4.0 is required"
+
+# Antenna indices of the sparse LBA configurations: 0, 49, 2, 51, ... and 1, 48, 3, 50, ...
+_SPARSE_EVEN_IDX = np.empty(48, dtype=np.intp)
+_SPARSE_EVEN_IDX[0::2] = np.arange(0, 48, 2)
+_SPARSE_EVEN_IDX[1::2] = np.arange(49, 96, 2)
+_SPARSE_ODD_IDX = np.empty(48, dtype=np.intp)
+_SPARSE_ODD_IDX[0::2] = np.arange(1, 48, 2)
+_SPARSE_ODD_IDX[1::2] = np.arange(48, 96, 2)
+
+# Indices into the flat list of HBA dipoles (16 per tile) of the single active dipole per tile
+_HBA_DIPOLE_IDX = {
+    station_type: np.asarray(config, dtype=np.intp) + np.arange(len(config), dtype=np.intp) * 16
+    for station_type, config in (('intl', GENERIC_INT_201512), ('remote', GENERIC_REMOTE_201512),
+                                 ('core', GENERIC_CORE_201512))
+}
+
+
+
+class RCUMode(IntEnum):
+    """Receiver (RCU) modes, with the sparse LBA antenna sets as extra modes"""
+    LBA_OUTER_10_90 = 1
+    LBA_OUTER_30_90 = 2
+    LBA_INNER_10_90 = 3
+    LBA_INNER_30_90 = 4
+    HBA_110_190 = 5
+    HBA_170_230 = 6
+    HBA_210_250 = 7
+    SPARSE_EVEN = 101
+    SPARSE_ODD = 102
+
+
+# Named rcu modes that are accepted besides the mode numbers
+_RCU_MODE_NAMES = {
+    'outer': RCUMode.LBA_OUTER_10_90, 'inner': RCUMode.LBA_INNER_10_90, 'sparse': RCUMode.SPARSE_EVEN,
+    'sparse_even': RCUMode.SPARSE_EVEN, 'sparse_odd': RCUMode.SPARSE_ODD
+}
+
+_LBA_MODES = frozenset({RCUMode.LBA_OUTER_10_90, RCUMode.LBA_OUTER_30_90, RCUMode.LBA_INNER_10_90,
+                        RCUMode.LBA_INNER_30_90, RCUMode.SPARSE_EVEN, RCUMode.SPARSE_ODD})
+_HBA_MODES = frozenset({RCUMode.HBA_110_190, RCUMode.HBA_170_230, RCUMode.HBA_210_250})
+
+# Sample clock and frequency offset (both in Hz) per rcu mode
+_RCU_PARAMS = {mode: (200e6, 0) for mode in _LBA_MODES}
+_RCU_PARAMS.update({RCUMode.HBA_110_190: (200e6, 100e6), RCUMode.HBA_170_230: (160e6, 160e6),
+                    RCUMode.HBA_210_250: (200e6, 200e6)})
+
+# Suffix of the caltable file name per rcu mode
+_CALTABLE_SUFFIX = {
+    RCUMode.LBA_OUTER_10_90: "-LBA_OUTER-10_90.dat", RCUMode.LBA_OUTER_30_90: "-LBA_OUTER-10_90.dat",
+    RCUMode.LBA_INNER_10_90: "-LBA_INNER-10_90.dat", RCUMode.LBA_INNER_30_90: "-LBA_INNER-10_90.dat",
+    RCUMode.HBA_110_190: "-HBA-110_190.dat", RCUMode.HBA_170_230: "-HBA-170_230.dat",
+    RCUMode.HBA_210_250: "-HBA-210_250.dat",
+    RCUMode.SPARSE_EVEN: "-LBA_SPARSE_EVEN-10_90.dat", RCUMode.SPARSE_ODD: "-LBA_SPARSE_ODD-10_90.dat"
+}
+
+# Subset of the LBA antennas used per rcu mode in core and remote stations
+_LBA_SUBSET = {
+    RCUMode.LBA_OUTER_10_90: slice(48, None), RCUMode.LBA_OUTER_30_90: slice(48, None),
+    RCUMode.LBA_INNER_10_90: slice(0, 48), RCUMode.LBA_INNER_30_90: slice(0, 48),
+    RCUMode.SPARSE_EVEN: _SPARSE_EVEN_IDX, RCUMode.SPARSE_ODD: _SPARSE_ODD_IDX
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _coerce_rcu(rcu_mode: Union[str, int]) -> RCUMode:
+    """Convert an rcu mode as passed to the public functions (int, str or RCUMode) to RCUMode"""
+    if str(rcu_mode) in _RCU_MODE_NAMES:
+        return _RCU_MODE_NAMES[str(rcu_mode)]
+    try:
+        return RCUMode(int(rcu_mode))
+    except ValueError:
+        raise RuntimeError("Unexpected rcu_mode: " + str(rcu_mode)) from None
+
 
-assert version.parse(lofarantpos.__version__) >= version.parse("0.4.0")
 
+def _rcu_params(rcu_mode: Union[str, int]) -> Tuple[float, float]:
+    """Sample clock and frequency offset (in Hz) of an rcu mode, with the LBA values for unknown modes"""
+    try:
+        return _RCU_PARAMS[_coerce_rcu(rcu_mode)]
+    except RuntimeError:
+        return 200e6, 0
 
 def sb_from_freq(freq: float, rcu_mode: Union[int, str] = 1) -> int:
     """
@@ -71,17 +159,7 @@ def sb_from_freq(freq: float, rcu_mode: Union[int, str] = 1) -> int:
         >>> sb_from_freq(58007812.5, '3')
         297
     """
-    clock = 200e6
-    if int(rcu_mode) == 6:
-        clock = 160e6
-
-    freq_offset = 0
-    if int(rcu_mode) == 5:
-        freq_offset = 100e6
-    elif int(rcu_mode) == 6:
-        freq_offset = 160e6
-    elif int(rcu_mode) == 7:
-        freq_offset = 200e6
+    clock, freq_offset = _rcu_params(rcu_mode)
 
     sb_bandwidth = 0.5 * clock / 512.
     sb = round((freq - freq_offset) / sb_bandwidth)
@@ -103,19 +181,7 @@ def freq_from_sb(sb: int, rcu_mode: Union[str, int] = 1):
         >>> freq_from_sb(297, '3')
         58007812.5
     """
-    clock = 200e6
-    freq_offset = 0
-
-    if 'sparse' not in str(rcu_mode):
-        if int(rcu_mode) == 6:
-            clock = 160e6
-
-        if int(rcu_mode) == 5:
-            freq_offset = 100e6
-        elif int(rcu_mode) == 6:
-            freq_offset = 160e6
-        elif int(rcu_mode) == 7:
-            freq_offset = 200e6
+    clock, freq_offset = _rcu_params(rcu_mode)
 
     sb_bandwidth = 0.5 * clock / 512.
     freq = (sb * sb_bandwidth) + freq_offset
@@ -141,42 +207,38 @@ def find_caltable(field_name: str, rcu_mode: Union[str, int], caltable_dir='calt
         >>> find_caltable("ES615HBA", "5") is None
         True
     """
+    rcu_mode = _coerce_rcu(rcu_mode)
+    key = (field_name, rcu_mode, caltable_dir)
+    # Only found caltables are cached, so that a caltable added later is still found.
+    # A cached path is checked again, in case the file was removed since.
+    cached = _caltable_cache.get(key)
+    if cached is not None and os.path.exists(cached):
+        return cached
+    caltable = _find_caltable_uncached(field_name, rcu_mode, caltable_dir)
+    if caltable is None:
+        _caltable_cache.pop(key, None)
+    else:
+        _caltable_cache[key] = caltable
+    return caltable
+
+
+# (field_name, rcu_mode, caltable_dir) -> path of the caltable found for it
+_caltable_cache = {}
+
+
+def _find_caltable_uncached(field_name: str, rcu_mode: RCUMode, caltable_dir: str):
+    """Implementation of find_caltable, without the cache"""
     station, field = field_name[0:5].upper(), field_name[5:].upper()
     station_number = station[2:5]
 
-    filename = f"CalTable-{station_number}"
-
-    if str(rcu_mode) in ('outer', '1', '2'):
-        filename += "-LBA_OUTER-10_90.dat"
-    elif str(rcu_mode) in ('inner', '3', '4'):
-        filename += "-LBA_INNER-10_90.dat"
-    elif str(rcu_mode) == '5':
-        filename += "-HBA-110_190.dat"
-    elif str(rcu_mode) == '6':
-        filename += "-HBA-170_230.dat"
-    elif str(rcu_mode) == '7':
-        filename += "-HBA-210_250.dat"
-    elif str(rcu_mode) == 'sparse_even':
-        filename += "-LBA_SPARSE_EVEN-10_90.dat"
-    elif str(rcu_mode) == 'sparse_odd':
-        filename += "-LBA_SPARSE_ODD-10_90.dat"
-    else:
-        raise RuntimeError("Unexpected mode: " + str(rcu_mode) + " for field_name " + str(field_name))
-
-    if os.path.exists(os.path.join(caltable_dir, filename)):
-        # All caltables in one directory
-        # return os.path.normpath(os.path.join(caltable_dir, filename))
-        ###TO pass the test as windows user
-        path = os.path.normpath(os.path.join(caltable_dir, filename))
-        return path.replace("\\", "/") 
-    elif os.path.exists(os.path.join(caltable_dir, station, filename)):
-        # Caltables in a directory per station
-        # return os.path.normpath(os.path.join(caltable_dir, station, filename))
-        ###TO pass the test as windows user
-        path = os.path.normpath(os.path.join(caltable_dir, station, filename))
-        return path.replace("\\", "/") 
-    else:
-        return None
+    filename = f"CalTable-{station_number}" + _CALTABLE_SUFFIX[rcu_mode]
+
+    # First all caltables in one directory, then caltables in a directory per station.
+    # Paths are returned with forward slashes, also on Windows
+    for candidate in (os.path.join(caltable_dir, filename), os.path.join(caltable_dir, station, filename)):
+        if os.path.exists(candidate):
+            return pathlib.PurePath(os.path.normpath(candidate)).as_posix()
+    return None
 
 
 def read_caltable(filename: str, num_subbands=512) -> Tuple[Dict[str, str], np.ndarray]:
@@ -190,7 +252,8 @@ def read_caltable(filename: str, num_subbands=512) -> Tuple[Dict[str, str], np.n
     Returns:
         Tuple[Dict[str, str], np.ndarray]: A tuple containing a dict with
             the header lines, and a 2D numpy.array of complex numbers
-            representing the station gain coefficients.
+            representing the station gain coefficients. The gains are stored
+            as complex128 on disk but returned as complex64.
     """
     infile = open(filename, 'rb')
 
@@ -206,7 +269,7 @@ def read_caltable(filename: str, num_subbands=512) -> Tuple[Dict[str, str], np.n
         infile.close()
         infile = open(filename, 'rb')
 
-    caldata = np.fromfile(infile, dtype=np.complex128)
+    caldata = np.fromfile(infile, dtype=np.complex128).astype(np.complex64)
     num_rcus = len(caldata) // num_subbands
 
     infile.close()
@@ -217,6 +280,32 @@ def read_caltable(filename: str, num_subbands=512) -> Tuple[Dict[str, str], np.n
     return header_dict, caldata.reshape((num_subbands, num_rcus))
 
 
+@functools.lru_cache(maxsize=8)
+def _read_caltable_cached(filename: str, num_subbands=512) -> Tuple[Dict[str, str], np.ndarray]:
+    """Cached version of read_caltable; the returned gains are read-only"""
+    cal_header, cal_data = read_caltable(filename, num_subbands)
+    cal_data.setflags(write=False)
+    return cal_header, cal_data
+
+
+@functools.lru_cache(maxsize=64)
+def _inverse_rcu_gains(filename: str, subband: int) -> np.ndarray:
+    """Reciprocal of the gains in a caltable for one subband (read-only)"""
+    _, cal_data = _read_caltable_cached(filename)
+    inv_gains = np.reciprocal(cal_data[subband, :])
+    inv_gains.setflags(write=False)
+    return inv_gains
+
+
+@numba.jit(parallel=True, fastmath=True, nopython=True)
+def _scale_by_inverse_gains(visibilities, inv_gains, out):
+    for i in numba.prange(out.shape[0]):
+        row_gain = inv_gains[i].conjugate()
+        for j in range(out.shape[1]):
+            out[i, j] = visibilities[i, j] * row_gain * inv_gains[j]
+    return out
+
+
 def apply_calibration(visibilities: np.ndarray, station_name: str, rcu_mode: Union[str, int],
                       subband: int, caltable_dir: str = "CalTables"):
     """
@@ -231,6 +320,15 @@ def apply_calibration(visibilities: np.ndarray, station_name: str, rcu_mode: Uni
 
     Returns:
         Tuple[np.ndarray, Dict[str, str]]: modified visibilities and dictionary with calibration info
+
+    Raises:
+        ValueError: If the visibilities are not a square matrix with one row per gain in the caltable
+
+    Example:
+        >>> apply_calibration(np.ones((96, 96)), "DE603", 3, 297, caltable_dir="test/CalTables")
+        Traceback (most recent call last):
+            ...
+        ValueError: Visibilities of shape (96, 96) do not match the 192 gains in the caltable
     """
     caltable_filename = find_caltable(station_name, rcu_mode=rcu_mode,
                                       caltable_dir=caltable_dir)
@@ -238,12 +336,17 @@ def apply_calibration(visibilities: np.ndarray, station_name: str, rcu_mode: Uni
     if caltable_filename is None:
         print('No calibration table found... cube remains uncalibrated!')
     else:
-        cal_header, cal_data = read_caltable(caltable_filename)
-
-        rcu_gains = cal_data[subband, :]
-        rcu_gains = np.array(rcu_gains, dtype=np.complex64)
-        gain_matrix = rcu_gains[np.newaxis, :] * np.conj(rcu_gains[:, np.newaxis])
-        visibilities = visibilities / gain_matrix
+        cal_header = dict(_read_caltable_cached(caltable_filename)[0])
+        inv_gains = _inverse_rcu_gains(caltable_filename, subband)
+        # The kernel does not check bounds, so the sizes must match exactly
+        if visibilities.ndim != 2 or visibilities.shape != (len(inv_gains), len(inv_gains)):
+            raise ValueError(f"Visibilities of shape {visibilities.shape} do not match "
+                             f"the {len(inv_gains)} gains in the caltable")
+        # The gain matrix conj(g_i) * g_j is rank one, so dividing by it is a
+        # scaling of the rows and columns; no N x N gain matrix is needed and
+        # the cast to complex64 and both scalings are done in a single pass
+        visibilities = _scale_by_inverse_gains(visibilities, inv_gains,
+                                               np.empty(visibilities.shape, dtype=np.complex64))
 
     return visibilities, cal_header
 
@@ -263,6 +366,31 @@ def rcus_in_station(station_type: str):
     return {'core': 96, 'remote': 96, 'intl': 192}[station_type]
 
 
+def read_acm_cube(filename: str, station_type: str) -> np.ndarray:
+    """
+    Read an ACM binary data cube (.dat file)
+
+    The file is memory-mapped rather than read, so only the time slots that
+    are accessed are paged in from disk.
+
+    Args:
+        filename: File name
+        station_type: Station type, one of 'intl', 'core', 'remote'
+
+    Returns:
+        np.array: Read-only array with cube, shape [n_timeslots, n_rcu, n_rcu]
+
+    Example:
+        >>> cube = read_acm_cube("test/20170720_095816_mode_3_xst_sb297.dat", "intl")
+        >>> cube.shape
+        (29, 192, 192)
+    """
+    num_rcu = rcus_in_station(station_type)
+    data = np.memmap(filename, dtype=np.complex128, mode='r')
+    time_slots = data.size // (num_rcu * num_rcu)
+    return data[:time_slots * num_rcu * num_rcu].reshape((time_slots, num_rcu, num_rcu))
+
+
 def get_station_type(station_name: str) -> str:
     """
     Get the station type, one of 'intl', 'core' or 'remote'
@@ -307,34 +435,19 @@ def get_station_pqr(station_name: str, rcu_mode: Union[str, int], db):
         >>> pqr.shape
         (96, 3)
     """
+    rcu_mode = _coerce_rcu(rcu_mode)
     full_station_name = get_full_station_name(station_name, rcu_mode)
     station_type = get_station_type(full_station_name)
 
-    if 'LBA' in station_name or str(rcu_mode) in ('1', '2', '3', '4', 'inner', 'outer', 'sparse_even', 'sparse_odd', 'sparse'):
+    if 'LBA' in station_name or rcu_mode in _LBA_MODES:
         if (station_type == 'core' or station_type == 'remote'):
-            if str(rcu_mode) in ('3', '4', 'inner'):
-                station_pqr = db.antenna_pqr(full_station_name)[0:48, :]
-            elif str(rcu_mode) in ('1', '2', 'outer'):
-                station_pqr = db.antenna_pqr(full_station_name)[48:, :]
-            elif rcu_mode in ('sparse_even', 'sparse'):
-                all_pqr = db.antenna_pqr(full_station_name)
-                # Indices 0, 49, 2, 51, 4, 53, ...
-                station_pqr = np.ravel(np.column_stack((all_pqr[:48:2], all_pqr[49::2]))).reshape(48, 3)
-            elif rcu_mode == 'sparse_odd':
-                all_pqr = db.antenna_pqr(full_station_name)
-                # Indices 1, 48, 3, 50, 5, 52, ...
-                station_pqr = np.ravel(np.column_stack((all_pqr[1:48:2], all_pqr[48::2]))).reshape(48, 3)
-            else:
-                raise RuntimeError("Cannot select subset of LBA antennas for mode " + rcu_mode)
+            if rcu_mode not in _LBA_SUBSET:
+                raise RuntimeError("Cannot select subset of LBA antennas for mode " + str(rcu_mode))
+            station_pqr = db.antenna_pqr(full_station_name)[_LBA_SUBSET[rcu_mode]]
         else:
             station_pqr = db.antenna_pqr(full_station_name)
-    elif 'HBA' in station_name or str(rcu_mode) in ('5', '6', '7', '8'):
-        selected_dipole_config = {
-            'intl': GENERIC_INT_201512, 'remote': GENERIC_REMOTE_201512, 'core': GENERIC_CORE_201512
-        }
-        selected_dipoles = selected_dipole_config[station_type] + \
-            np.arange(len(selected_dipole_config[station_type])) * 16
-        station_pqr = db.hba_dipole_pqr(full_station_name)[selected_dipoles]
+    elif 'HBA' in station_name or rcu_mode in _HBA_MODES:
+        station_pqr = db.hba_dipole_pqr(full_station_name)[_HBA_DIPOLE_IDX[station_type]]
     else:
         raise RuntimeError("Station name did not contain LBA or HBA, could not load antenna positions")
 
@@ -362,8 +475,8 @@ def get_station_xyz(station_name: str, rcu_mode: Union[str, int], db):
         >>> xyz, _ = get_station_xyz("DE603", "outer", db)
         >>> xyz.shape
         (96, 3)
-        >>> f"{xyz[0, 0]:.7f}"
-        '2.7033776'
+        >>> f"{xyz[0, 0]:.5f}"
+        '2.70338'
 
         >>> xyz, _ = get_station_xyz("LV614", "5", db)
         >>> xyz.shape
@@ -377,13 +490,69 @@ def get_station_xyz(station_name: str, rcu_mode: Union[str, int], db):
 
     pqr_to_xyz = np.array([[np.cos(-rotation), -np.sin(-rotation), 0],
                            [np.sin(-rotation), np.cos(-rotation), 0],
-                           [0, 0, 1]])
+                           [0, 0, 1]], dtype=np.float32)
+
+    # Keep float32 so that the baselines built from this stay float32 as well
+    station_xyz = station_pqr @ pqr_to_xyz.T
+
+    return station_xyz, pqr_to_xyz
 
-    station_xyz = (pqr_to_xyz @ station_pqr.T).T
 
+@functools.lru_cache(maxsize=1)
+def _get_db() -> LofarAntennaDatabase:
+    """Shared LofarAntennaDatabase instance, so the antenna tables are parsed only once"""
+    return LofarAntennaDatabase()
+
+
+@functools.lru_cache(maxsize=16)
+def _get_station_xyz_cached(station_name: str, rcu_mode: Union[str, int]):
+    """
+    Cached version of get_station_xyz using the shared antenna database.
+    The returned arrays are shared between callers and therefore read-only.
+    """
+    station_xyz, pqr_to_xyz = get_station_xyz(station_name, rcu_mode, _get_db())
+    station_xyz.setflags(write=False)
+    pqr_to_xyz.setflags(write=False)
     return station_xyz, pqr_to_xyz
 
 
+@functools.lru_cache(maxsize=16)
+def get_station_baselines(station_name: str, rcu_mode: Union[str, int]) -> np.ndarray:
+    """
+    Get the baselines between all antenna pairs of a station.
+    The result is cached and shared between callers, and therefore read-only.
+
+    Args:
+        station_name (str): Station name, e.g. "DE603"
+        rcu_mode (Union[str, int]): RCU mode
+
+    Returns:
+        np.ndarray: Baselines, shape [n_ant, n_ant, 3]
+
+    Example:
+        >>> get_station_baselines("LV614", 3).shape
+        (96, 96, 3)
+    """
+    station_xyz, _ = _get_station_xyz_cached(station_name, rcu_mode)
+    baselines = station_xyz[:, np.newaxis, :] - station_xyz[np.newaxis, :, :]
+    baselines.setflags(write=False)
+    return baselines
+
+
+@functools.lru_cache(maxsize=16)
+def get_station_earthlocation(full_station_name: str) -> EarthLocation:
+    """
+    Get the location of the phase centre of a station. The result is cached.
+
+    Args:
+        full_station_name (str): Full station name, e.g. "LV614LBA"
+
+    Returns:
+        EarthLocation: Phase centre of the station
+    """
+    return EarthLocation.from_geocentric(*(_get_db().phase_centres[full_station_name] * u.m))
+
+
 def get_full_station_name(station_name: str, rcu_mode: Union[str, int]) -> str:
     """
     Get full station name with the field appended, e.g. DE603LBA
@@ -411,31 +580,45 @@ def get_full_station_name(station_name: str, rcu_mode: Union[str, int]) -> str:
     if len(station_name) > 5:
         return station_name
 
-    if str(rcu_mode) in ('1', '2', 'outer'):
-        station_name += "LBA"
-    elif str(rcu_mode) in ('3', '4', 'inner'):
-        station_name += "LBA"
-    elif 'sparse' in str(rcu_mode):
-        station_name += "LBA"
-    elif str(rcu_mode) in ('5', '6', '7'):
-        station_name += "HBA"
-    else:
-        raise Exception("Unexpected rcu_mode: ", rcu_mode)
-
-    return station_name
+    if _coerce_rcu(rcu_mode) in _LBA_MODES:
+        return station_name + "LBA"
+    return station_name + "HBA"
 
 def make_sky_movie(moviefilename: str, h5file: h5py.File, obsnums: List[str], vmin=None, vmax=None,
                    marked_bodies=["Cas A", "Cyg A", "Sun"]) -> None:
     """
     Make movie of a list of observations
+
+    The figure is built once; every frame only updates the image data, the
+    source markers and the subtitle.
     """
-    fig = plt.figure(figsize=(10,10))
-    for obsnum in tqdm.tqdm(obsnums):
-        obs_h5 = h5file[obsnum]
-        skydata_h5 = obs_h5["sky_img"]
+    first_obs_h5 = h5file[obsnums[0]]
+    station_name = first_obs_h5.attrs["station_name"]
+
+    fig, ax = plt.subplots(figsize=(10, 10))
+    circle1 = Circle((0, 0), 1.0, edgecolor='k', fill=False, facecolor='none', alpha=0.3)
+    ax.add_artist(circle1)
+    cimg = ax.imshow(read_dataset(first_obs_h5["sky_img"]), origin='lower', cmap=cm.Spectral_r,
+                     extent=(1, -1, -1, 1), clip_path=circle1, clip_on=True, vmin=vmin, vmax=vmax, animated=True)
+    ax.set_xlim(1, -1)
+    ax.set_ylim(-1, 1)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_aspect('equal')
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes("right", size="5%", pad=0.2, axes_class=maxes.Axes)
+    fig.colorbar(cimg, cax=cax, orientation="vertical", format="%.2e")
+    fig.suptitle(f"Sky image for {station_name}", fontsize=16)
+
+    markers, = ax.plot([], [], marker='x', linestyle='', color='black', mew=0.5, animated=True)
+    subtitle = ax.set_title("", fontsize=8)
+    subtitle.set_animated(True)
+    labels = {}
+
+    def update(frame_num):
+        obs_h5 = h5file[obsnums[frame_num]]
         obstime = obs_h5.attrs["obstime"]
         freq = obs_h5.attrs["frequency"]
-        station_name = obs_h5.attrs["station_name"]
         subband = obs_h5.attrs["subband"]
         marked_bodies_lmn = {
             name: {
@@ -444,9 +627,9 @@ def make_sky_movie(moviefilename: str, h5file: h5py.File, obsnums: List[str], vm
                 'azimuth': azimuth
             }
             for name, lmn, elevation, azimuth in zip(
-                obs_h5.attrs["source_names"], 
-                obs_h5.attrs["source_lmn"], 
-                obs_h5.attrs["source_elevations"], 
+                obs_h5.attrs["source_names"],
+                obs_h5.attrs["source_lmn"],
+                obs_h5.attrs["source_elevations"],
                 obs_h5.attrs["source_azimuths"]
             )
         }
@@ -455,22 +638,36 @@ def make_sky_movie(moviefilename: str, h5file: h5py.File, obsnums: List[str], vm
             [f"{name}: Elevation {data['elevation']:.2f}°, Azimuth {data['azimuth']:.2f}°"
             for name, data in marked_bodies_lmn.items()]
         )
+        subtitle.set_text(f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}\n" + bodies_info)
+
+        cimg.set_data(read_dataset(obs_h5["sky_img"]))
+        if vmin is None or vmax is None:
+            cimg.autoscale()
+        cimg.set_clim(vmin, vmax)
 
-        subtitle_text = (f"SB {subband} ({freq / 1e6:.1f} MHz), {str(obstime)[:16]}\n" + bodies_info)
-        
         # if marked_bodies is not None:
         #     marked_bodies_lmn = {k: v for k, v in marked_bodies_lmn.items() if k in marked_bodies}
-        make_sky_plot(skydata_h5[:, :], marked_bodies_lmn,
-                      title=f"Sky image for {station_name}",
-                      subtitle=subtitle_text,
-                      animated=True, fig=fig, label=obsnum, vmin=vmin, vmax=vmax)
+        markers.set_data([data['lmn'][0] for data in marked_bodies_lmn.values()],
+                         [data['lmn'][1] for data in marked_bodies_lmn.values()])
+        for label in labels.values():
+            label.set_visible(False)
+        for name, data in marked_bodies_lmn.items():
+            if name not in labels:
+                labels[name] = ax.text(0, 0, name, color='black', fontsize=9, ha='left', va='bottom',
+                                       animated=True)
+            labels[name].set_position((data['lmn'][0], data['lmn'][1]))
+            labels[name].set_visible(True)
+
+        return [cimg, markers, subtitle, *labels.values()]
 
     # Thanks to Maaijke Mevius for making this animation work!
-    ims = fig.get_children()[1:]
-    ims = [ims[i:i+2] for i in range(0, len(ims), 2)]
-    ani = matplotlib.animation.ArtistAnimation(fig, ims, interval=30, blit=False, repeat_delay=1000)
+    ani = matplotlib.animation.FuncAnimation(fig, update, frames=len(obsnums), interval=30, blit=True,
+                                             repeat_delay=1000)
     writer = matplotlib.animation.writers['ffmpeg'](fps=5, bitrate=800)
-    ani.save(moviefilename, writer=writer, dpi=fig.dpi)
+    with tqdm.tqdm(total=len(obsnums)) as pbar:
+        ani.save(moviefilename, writer=writer, dpi=fig.dpi,
+                 progress_callback=lambda frame_num, total_frames: pbar.update(1))
+    plt.close(fig)
 
 
 def reimage_sky(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntennaDatabase,
@@ -499,17 +696,13 @@ def reimage_sky(h5: h5py.File, obsnum: str, db: lofarantpos.db.LofarAntennaDatab
     sky_data = h5[obsnum]["sky_img"]
     freq = h5[obsnum].attrs['frequency']
     marked_bodies_lmn = dict(zip(h5[obsnum].attrs["source_names"], h5[obsnum].attrs["source_lmn"]))
-    visibilities = h5[obsnum]['calibrated_data'][:]
-    visibilities_xx = visibilities[0::2, 0::2]
-    visibilities_yy = visibilities[1::2, 1::2]
-    # Stokes I
-    visibilities_stokes_i = visibilities_xx + visibilities_yy
+    visibilities = read_dataset(h5[obsnum]['calibrated_data'])
+    visibilities_stokes_i = stokes_i(visibilities)
 
     if subtract is not None:
-        station_xyz, _ = get_station_xyz(station_name, rcu_mode, db)
-        baselines = station_xyz[:, np.newaxis, :] - station_xyz[np.newaxis, :, :]
+        baselines = get_station_baselines(station_name, rcu_mode)
         visibilities_stokes_i = subtract_sources(visibilities_stokes_i, baselines, freq, marked_bodies_lmn, subtract)
-        sky_data = sky_imager(visibilities_stokes_i, baselines, freq, sky_data.shape[0], sky_data.shape[1])
+        sky_data = fast_sky_imager(visibilities_stokes_i, baselines, freq, sky_data.shape[0], sky_data.shape[1])
         if vmin is None:
             vmin = np.quantile(sky_data, 0.05)
 
@@ -2,8 +2,8 @@ import os
 import time
 from datetime import datetime, timedelta
 from tqdm import tqdm
-from PyQt6.QtCore import QObject, pyqtSignal, QCoreApplication
-from realtime_processor.monitor import detect_new_data_from_stream
+from PyQt6.QtCore import QObject, pyqtSignal, QCoreApplication, QEventLoop, QFileSystemWatcher, QTimer
+from realtime_processor.monitor import detect_new_data_from_stream, find_files, open_dat_file
 from realtime_processor.processor import get_subband, get_subband_from_shell, get_rcu_mode
 from realtime_processor.singlestationutil import sb_from_freq
 class DataProcessorWorker(QObject):
@@ -11,10 +11,12 @@ class DataProcessorWorker(QObject):
     finished = pyqtSignal()
     frequency_signal = pyqtSignal(str)
     
-    def __init__(self, input_dir, output_dir, realtime_mode=False):
+    def __init__(self, input_dir, output_dir, realtime_mode=False, poll=False):
         super().__init__()
         self.input_dir = input_dir
         self.output_dir = output_dir
+        self.poll = poll
+        self._dat_mtimes = {}
         self.waiting_for_plot = True
         self.selected_frequency = None
         self.realtime_mode = realtime_mode
@@ -44,15 +46,51 @@ class DataProcessorWorker(QObject):
         obsdatestr, obstimestr, *_ = basename.rstrip(".dat").split("_")
         return datetime.strptime(obsdatestr + ":" + obstimestr, '%Y%m%d:%H%M%S')
 
+    def _wait_for_change(self, watcher, timeout):
+        """
+        Block until the watcher reports a changed file or directory, or until timeout seconds have passed.
+        Returns the number of seconds waited.
+        """
+        loop = QEventLoop()
+        timer = QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(loop.quit)
+        watcher.directoryChanged.connect(loop.quit)
+        watcher.fileChanged.connect(loop.quit)
+        start = time.monotonic()
+        timer.start(max(int(timeout * 1000), 0))
+        loop.exec()
+        timer.stop()
+        watcher.directoryChanged.disconnect(loop.quit)
+        watcher.fileChanged.disconnect(loop.quit)
+        return time.monotonic() - start
+
+    def _poll_for_change(self, timeout, interval=5):
+        """
+        Polling fallback for file systems that do not deliver change notifications (NFS, CIFS).
+        Sleeps, then compares the modification times of the .dat files with the previous scan.
+        Returns the changed paths (the input directory if a file was added) and the number of seconds waited.
+        """
+        waited = min(interval, max(timeout, 0))
+        time.sleep(waited)
+        changed_paths = set()
+        for entry in find_files(self.input_dir, ".dat"):
+            mtime = entry.stat().st_mtime
+            if entry.path not in self._dat_mtimes:
+                changed_paths.add(self.input_dir)
+            elif self._dat_mtimes[entry.path] < mtime:
+                changed_paths.add(entry.path)
+                self._dat_mtimes[entry.path] = mtime
+        return changed_paths, waited
+
     def run(self):
         if self.realtime_mode:
             
             shell_script = None
-            for file in os.listdir(self.input_dir):
-                if file.endswith(".sh"):
-                    shell_script = os.path.join(self.input_dir, file)
-                    print(f"Shell script found: {shell_script}")
-                    break
+            shell_scripts = find_files(self.input_dir, ".sh")
+            if shell_scripts:
+                shell_script = shell_scripts[0].path
+                print(f"Shell script found: {shell_script}")
             if not shell_script:
                 print("No shell script found.")
                 ##DEFAULT parameters
@@ -63,7 +101,7 @@ class DataProcessorWorker(QObject):
                 min_subband, max_subband = get_subband_from_shell(shell_script)
 
             ## INICITALIZE VARIABLES
-            dat_files = [f for f in os.listdir(self.input_dir) if f.endswith(".dat")]
+            dat_files = [entry.name for entry in find_files(self.input_dir, ".dat")]
             if not dat_files:
                 print("No .dat files found in the input directory.")
                 self.finished.emit()
@@ -76,9 +114,9 @@ class DataProcessorWorker(QObject):
                 dat_path = os.path.join(self.input_dir, dat_file)
                 still_observing = True
                 self.last_obstime = self.get_obstime_from_filename(dat_path)
-                with open(dat_path, "rb") as f:
+                with open_dat_file(dat_path) as f:
+                    covariance_matrix, last_size, last_time = detect_new_data_from_stream(f, last_size, num_rcu=num_rcu, realtime_mode=True, last_time=last_time)
                     while still_observing:
-                        covariance_matrix, last_size, last_time = detect_new_data_from_stream(f, last_size , num_rcu, realtime_mode=True, last_time=last_time)
                         if covariance_matrix is not None:
                             self.waiting_for_plot = True
                             if subband <= max_subband:
@@ -87,9 +125,14 @@ class DataProcessorWorker(QObject):
                             elif subband > max_subband:
                                 subband = min_subband
                                 self.update_signal.emit(covariance_matrix, dat_path, subband, rcu_mode, self.last_obstime)
+                            # Read the next matrix while the GUI thread is plotting this one
+                            covariance_matrix, last_size, last_time = detect_new_data_from_stream(f, last_size, num_rcu=num_rcu, realtime_mode=True, last_time=last_time)
                             while self.waiting_for_plot:
                                 QCoreApplication.processEvents()                            
                                 time.sleep(0.05)
+                            if covariance_matrix is None:
+                                # The next matrix was not written yet when it was prefetched; try again now
+                                covariance_matrix, last_size, last_time = detect_new_data_from_stream(f, last_size, num_rcu=num_rcu, realtime_mode=True, last_time=last_time)
 
                             self.last_obstime += timedelta(seconds=1)
                         else:
@@ -98,40 +141,57 @@ class DataProcessorWorker(QObject):
             self.finished.emit()
         else:
             shell_script = None
-            for file in os.listdir(self.input_dir):
-                if file.endswith(".sh"):
-                    shell_script = os.path.join(self.input_dir, file)
-                    break
+            shell_scripts = find_files(self.input_dir, ".sh")
+            if shell_scripts:
+                shell_script = shell_scripts[0].path
             if not shell_script:
                 print("No shell script found.")
                 rcu_mode = "3"
             else:
                 rcu_mode = get_rcu_mode(shell_script)
-            processed_files = {}
             timeout = 15
+            # Changes are reported by the file system watcher (inotify on Linux)
+            # instead of listing the directory and stat'ing every file each 5 s,
+            # unless polling was requested for network file systems
+            watcher = QFileSystemWatcher([self.input_dir])
+            changed_paths = set()
+            watcher.directoryChanged.connect(changed_paths.add)
+            watcher.fileChanged.connect(changed_paths.add)
+            changed_paths.add(self.input_dir)
+            new_files = {}  # file name -> size in bytes
             while True:
-                dat_files = [f for f in os.listdir(self.input_dir) if f.endswith(".dat")]
-                new_files = []
-                print(f"Detected {len(dat_files)} .dat files.")
-                for dat_file in dat_files:
-                    dat_path = os.path.join(self.input_dir, dat_file)
-                    last_modified = os.path.getmtime(dat_path)
-
-                    if dat_file not in processed_files or processed_files[dat_file] < last_modified:
-                        new_files.append(dat_file)
-                        processed_files[dat_file] = last_modified
-                    
-                if not new_files:
+                if not changed_paths:
                     print("No new .dat files found. Waiting...")
-                    time.sleep(5)
-                    timeout -= 5
-                    if timeout <= 0:
+                    if self.poll:
+                        polled_paths, waited = self._poll_for_change(timeout)
+                        changed_paths.update(polled_paths)
+                    else:
+                        waited = self._wait_for_change(watcher, timeout)
+                    timeout -= waited
+                    if not changed_paths:
+                        if timeout > 0:
+                            continue
                         print("Timeout. Exiting.")
                         break
 
-                # print(f"New files detected: {new_files}")
+                if any(os.path.isdir(path) for path in changed_paths):
+                    dat_files = find_files(self.input_dir, ".dat")
+                    print(f"Detected {len(dat_files)} .dat files.")
+                    watched_files = set(watcher.files())
+                    for entry in dat_files:
+                        if entry.path not in watched_files:
+                            watcher.addPath(entry.path)
+                            # The stat result is cached on the DirEntry, so this is a single call per file
+                            stat_result = entry.stat()
+                            self._dat_mtimes[entry.path] = stat_result.st_mtime
+                            new_files[entry.name] = stat_result.st_size
+                # Files that were written to since they were last processed
+                for path in changed_paths:
+                    if os.path.basename(path) not in new_files and os.path.isfile(path):
+                        new_files[os.path.basename(path)] = os.path.getsize(path)
+                changed_paths.clear()
 
-                for dat_file in new_files:
+                for dat_file, file_size in new_files.items():
                     dat_path = os.path.join(self.input_dir, dat_file)
                     header_file = dat_path.replace(".dat", ".h")
 
@@ -153,13 +213,12 @@ class DataProcessorWorker(QObject):
 
                     last_size = 0
                     last_time = None
-                    file_size = os.path.getsize(dat_path)
                     still_observing = True
                     self.last_used_frequency = None
                     first_block_read = True
                     pbar = tqdm(total=file_size, desc="Analyzing File", unit="B", unit_scale=True, unit_divisor=1024)
 
-                    with open(dat_path, "rb") as f:
+                    with open_dat_file(dat_path) as f:
                         while still_observing:
                             prev_size = last_size
                             covariance_matrix, last_size, last_time = detect_new_data_from_stream(f, last_size, first_block_read=first_block_read, last_time=last_time)
@@ -208,6 +267,7 @@ class DataProcessorWorker(QObject):
                             else:
                                 still_observing = False
                             pbar.update(last_size - prev_size)
+                new_files = {}
 
             # create_video(self.output_dir, os.path.join(self.output_dir, f"generated_video.mp4"))
             self.finished.emit()
@@ -12,12 +12,12 @@ setup(
         "numpy>=2.0.0",
         "matplotlib>=3.10.3",
         "astropy>=7.0.1",
-        "packaging>=24.1",
         "h5py>=3.13.0",
         "lofarantpos>=0.7.1",
         "numba>=0.61.0",
         "numexpr>=2.10.2",
         "opencv-python>=4.10.0.84",
+        "Pillow>=12.3.0",
         "PyQt6>=6.9.0",
         "tqdm>=4.67.1",
     ],